@@ -85,6 +85,13 @@ class CommandEvent(BaseCommandEvent):
         self.tgbot = processor.tgbot
         self.config = processor.config
         self.public_website = processor.public_website
+        self.allow_matrix_login = processor.allow_matrix_login
+
+    @property
+    def raw_args(self) -> str:
+        # The arguments are split on single spaces, so joining them restores the original text,
+        # including the command itself when this event was routed via command_status["next"].
+        return " ".join(self.args)
 
     @property
     def print_error_traceback(self) -> bool:
@@ -185,6 +192,7 @@ class CommandProcessor(BaseCommandProcessor):
         super().__init__(event_class=CommandEvent, bridge=bridge)
         self.tgbot = bridge.bot
         self.public_website = bridge.public_website
+        self.allow_matrix_login = bridge.config.get("bridge.allow_matrix_login", True)
 
     @staticmethod
     async def _run_handler(
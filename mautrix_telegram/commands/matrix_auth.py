@@ -34,7 +34,7 @@ async def login_matrix(evt: CommandEvent) -> EventID:
             "You have already logged in with your Matrix account. "
             "Log out with `$cmdprefix+sp logout-matrix` first."
         )
-    allow_matrix_login = evt.config.get("bridge.allow_matrix_login", True)
+    allow_matrix_login = evt.allow_matrix_login
     if allow_matrix_login:
         evt.sender.command_status = {
             "next": enter_matrix_token,
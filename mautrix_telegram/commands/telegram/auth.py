@@ -15,7 +15,7 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from __future__ import annotations
 
-from typing import Any
+from typing import Any, Callable
 import asyncio
 import io
 
@@ -33,6 +33,7 @@ from telethon.errors import (
     PhoneNumberUnoccupiedError,
     SessionPasswordNeededError,
 )
+from telethon.tl.custom import QRLogin
 from telethon.tl.types import User
 
 from mautrix.client import Client
@@ -51,13 +52,27 @@ from ... import user as u
 from ...commands import SECTION_AUTH, CommandEvent, command_handler
 from ...types import TelegramID
 
-try:
-    from telethon.tl.custom import QRLogin
-    import PIL as _
+
+def _qr_login_supported() -> bool:
+    # qrcode is only imported once someone actually tries to log in with a QR code
+    try:
+        import PIL as _
+        import qrcode as _
+    except ImportError:
+        return False
+    return True
+
+
+def _render_qr(url: str) -> tuple[bytes, int]:
     import qrcode
-except ImportError:
-    qrcode = None
-    QRLogin = None
+
+    qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_L, box_size=6, border=2)
+    qr.add_data(url)
+    qr.make(fit=True)
+    image = qr.make_image()
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG", optimize=False, compress_level=1)
+    return buffer.getvalue(), image.pixel_size
 
 
 @command_handler(
@@ -67,8 +82,9 @@ async def ping(evt: CommandEvent) -> EventID:
     if await evt.sender.is_logged_in():
         me = await evt.sender.get_me()
         if me:
-            human_tg_id = f"@{me.username}" if me.username else f"+{me.phone}"
-            return await evt.reply(f"You're logged in as {human_tg_id}")
+            return await evt.reply(
+                f"You're logged in as {u.format_human_tg_id(me.username, me.phone)}"
+            )
         else:
             return await evt.reply("You were logged in, but there appears to have been an error.")
     else:
@@ -102,7 +118,7 @@ async def login_qr(evt: CommandEvent) -> EventID:
     login_as = evt.sender
     if len(evt.args) > 0 and evt.sender.is_admin:
         login_as = await u.User.get_by_mxid(UserID(evt.args[0]))
-    if not qrcode or not QRLogin:
+    if not _qr_login_supported():
         return await evt.reply("This bridge instance does not support logging in with a QR code.")
     if await login_as.is_logged_in():
         return await evt.reply(f"You are already logged in as {login_as.human_tg_id}.")
@@ -111,13 +127,8 @@ async def login_qr(evt: CommandEvent) -> EventID:
     qr_login = QRLogin(login_as.client, ignored_ids=[])
     qr_event_id: EventID | None = None
 
-    async def upload_qr() -> None:
-        nonlocal qr_event_id
-        buffer = io.BytesIO()
-        image = qrcode.make(qr_login.url)
-        size = image.pixel_size
-        image.save(buffer, "PNG")
-        qr = buffer.getvalue()
+    async def upload_qr() -> EventID:
+        qr, size = await asyncio.to_thread(_render_qr, qr_login.url)
         mxc = await evt.az.intent.upload_media(qr, "image/png", "login-qr.png", len(qr))
         content = MediaMessageEventContent(
             body=qr_login.url,
@@ -126,19 +137,41 @@ async def login_qr(evt: CommandEvent) -> EventID:
             msgtype=MessageType.IMAGE,
             info=ImageInfo(mimetype="image/png", size=len(qr), width=size, height=size),
         )
+        content.set_reply(evt.event_id)
+        return await evt.az.intent.send_message(evt.room_id, content)
+
+    async def redact_qr(event_id: EventID) -> None:
+        try:
+            await evt.main_intent.redact(evt.room_id, event_id, reason="QR code expired")
+        except Exception:
+            pass
+
+    async def replace_qr() -> None:
+        nonlocal qr_event_id
         if qr_event_id:
-            content.set_edit(qr_event_id)
-            await evt.az.intent.send_message(evt.room_id, content)
+            # Send the new QR code and redact the old one in parallel
+            qr_event_id, _ = await asyncio.gather(upload_qr(), redact_qr(qr_event_id))
         else:
-            content.set_reply(evt.event_id)
-            qr_event_id = await evt.az.intent.send_message(evt.room_id, content)
+            qr_event_id = await upload_qr()
 
     retries = 4
     while retries > 0:
         await qr_login.recreate()
-        await upload_qr()
+        # The QR code can be scanned as soon as it's recreated, so start waiting for the login
+        # while the image is still being uploaded and sent to Matrix.
+        upload_task = asyncio.create_task(replace_qr())
+        wait_task = asyncio.create_task(qr_login.wait())
         try:
-            user = await qr_login.wait()
+            await asyncio.wait((upload_task, wait_task), return_when=asyncio.FIRST_COMPLETED)
+            if not wait_task.done() or isinstance(wait_task.exception(), asyncio.TimeoutError):
+                # Give up right away if the QR code couldn't be sent, and make sure the old one
+                # has been replaced before retrying.
+                await asyncio.wait((upload_task,))
+                if upload_task.exception():
+                    return await evt.reply(
+                        "Failed to send the QR code. Check console for more details."
+                    )
+            user = await wait_task
             break
         except asyncio.TimeoutError:
             retries -= 1
@@ -151,10 +184,16 @@ async def login_qr(evt: CommandEvent) -> EventID:
             return await evt.reply(
                 "Your account has two-factor authentication. Please send your password here."
             )
-        try:
-            await evt.main_intent.redact(evt.room_id, qr_event_id, reason="QR code scanned")
-        except Exception:
-            pass
+        finally:
+            wait_task.cancel()
+            upload_task.cancel()
+            await asyncio.gather(wait_task, return_exceptions=True)
+            try:
+                await upload_task
+            except asyncio.CancelledError:
+                pass
+            except Exception:
+                evt.log.exception("Failed to send login QR code")
     else:
         timeout = TextMessageEventContent(body="Login timed out", msgtype=MessageType.TEXT)
         timeout.set_edit(qr_event_id)
@@ -191,7 +230,7 @@ async def login(evt: CommandEvent) -> EventID:
     if await evt.sender.is_logged_in():
         return await evt.reply(f"You are already logged in as {evt.sender.human_tg_id}.")
 
-    allow_matrix_login = evt.config["bridge.allow_matrix_login"]
+    allow_matrix_login = evt.allow_matrix_login
     if allow_matrix_login and not override_sender:
         evt.sender.command_status = {
             "next": enter_phone_or_token,
@@ -205,7 +244,7 @@ async def login(evt: CommandEvent) -> EventID:
         if override_sender:
             return await evt.reply(
                 f"[Click here to log in]({url}) as "
-                f"[{evt.sender.mxid}](https://matrix.to/#/{evt.sender.mxid})."
+                f"[{evt.sender.mxid}]({evt.sender.matrix_to_url})."
             )
         elif allow_matrix_login:
             return await evt.reply(
@@ -226,6 +265,27 @@ async def login(evt: CommandEvent) -> EventID:
     return await evt.reply("This bridge instance has been configured to not allow logging in.")
 
 
+_REQUEST_CODE_ERRORS: dict[type[Exception], str | Callable[[Exception], str]] = {
+    PhoneNumberAppSignupForbiddenError: (
+        "Your phone number does not allow 3rd party apps to sign in."
+    ),
+    PhoneNumberFloodError: (
+        "Your phone number has been temporarily blocked for flooding. "
+        "The ban is usually applied for around a day."
+    ),
+    FloodWaitError: lambda e: (
+        "Your phone number has been temporarily blocked for flooding. "
+        f"Please wait for {fmt_duration(e.seconds)} before trying again."
+    ),
+    PhoneNumberBannedError: "Your phone number has been banned from Telegram.",
+    PhoneNumberUnoccupiedError: (
+        "That phone number has not been registered. "
+        "Please sign up to Telegram using an official mobile client first."
+    ),
+    PhoneNumberInvalidError: "That phone number is not valid.",
+}
+
+
 async def _request_code(
     evt: CommandEvent, phone_number: str, next_status: dict[str, Any]
 ) -> EventID:
@@ -235,32 +295,17 @@ async def _request_code(
         await evt.sender.client.sign_in(phone_number)
         ok = True
         return await evt.reply(f"Login code sent to {phone_number}. Please send the code here.")
-    except PhoneNumberAppSignupForbiddenError:
-        return await evt.reply("Your phone number does not allow 3rd party apps to sign in.")
-    except PhoneNumberFloodError:
-        return await evt.reply(
-            "Your phone number has been temporarily blocked for flooding. "
-            "The ban is usually applied for around a day."
-        )
-    except FloodWaitError as e:
-        return await evt.reply(
-            "Your phone number has been temporarily blocked for flooding. "
-            f"Please wait for {fmt_duration(e.seconds)} before trying again."
-        )
-    except PhoneNumberBannedError:
-        return await evt.reply("Your phone number has been banned from Telegram.")
-    except PhoneNumberUnoccupiedError:
-        return await evt.reply(
-            "That phone number has not been registered. "
-            "Please sign up to Telegram using an official mobile client first."
-        )
-    except PhoneNumberInvalidError:
-        return await evt.reply("That phone number is not valid.")
-    except Exception:
-        evt.log.exception("Error requesting phone code")
-        return await evt.reply(
-            "Unhandled exception while requesting code. Check console for more details."
+    except Exception as e:
+        reply = next(
+            (_REQUEST_CODE_ERRORS[cls] for cls in type(e).__mro__ if cls in _REQUEST_CODE_ERRORS),
+            None,
         )
+        if reply is None:
+            evt.log.exception("Error requesting phone code")
+            return await evt.reply(
+                "Unhandled exception while requesting code. Check console for more details."
+            )
+        return await evt.reply(reply(e) if callable(reply) else reply)
     finally:
         evt.sender.command_status = next_status if ok else None
 
@@ -269,14 +314,14 @@ async def _request_code(
 async def enter_phone_or_token(evt: CommandEvent) -> EventID | None:
     if len(evt.args) == 0:
         return await evt.reply("**Usage:** `$cmdprefix+sp enter-phone-or-token <phone-or-token>`")
-    elif not evt.config.get("bridge.allow_matrix_login", True):
+    elif not evt.allow_matrix_login:
         return await evt.reply(
             "This bridge instance does not allow in-Matrix login. "
             "Please use `$cmdprefix+sp login` to get login instructions"
         )
 
     # phone numbers don't contain colons but telegram bot auth tokens do
-    if evt.args[0].find(":") > 0:
+    if ":" in evt.args[0]:
         try:
             await _sign_in(evt, bot_token=evt.args[0])
         except Exception:
@@ -293,7 +338,7 @@ async def enter_phone_or_token(evt: CommandEvent) -> EventID | None:
 async def enter_code(evt: CommandEvent) -> EventID | None:
     if len(evt.args) == 0:
         return await evt.reply("**Usage:** `$cmdprefix+sp enter-code <code>`")
-    elif not evt.config.get("bridge.allow_matrix_login", True):
+    elif not evt.allow_matrix_login:
         return await evt.reply(
             "This bridge instance does not allow in-Matrix login. "
             "Please use `$cmdprefix+sp login` to get login instructions"
@@ -312,7 +357,7 @@ async def enter_code(evt: CommandEvent) -> EventID | None:
 async def enter_password(evt: CommandEvent) -> EventID | None:
     if len(evt.args) == 0:
         return await evt.reply("**Usage:** `$cmdprefix+sp enter-password <password>`")
-    elif not evt.config.get("bridge.allow_matrix_login", True):
+    elif not evt.allow_matrix_login:
         return await evt.reply(
             "This bridge instance does not allow in-Matrix login. "
             "Please use `$cmdprefix+sp login` to get login instructions"
@@ -322,7 +367,7 @@ async def enter_password(evt: CommandEvent) -> EventID | None:
         await _sign_in(
             evt,
             login_as=evt.sender.command_status.get("login_as", None),
-            password=" ".join(evt.args),
+            password=evt.raw_args,
         )
     except AccessTokenInvalidError:
         return await evt.reply("That bot token is not valid.")
@@ -364,17 +409,14 @@ async def _finish_sign_in(evt: CommandEvent, user: User, login_as: u.User = None
     if existing_user and existing_user != login_as:
         await existing_user.log_out()
         await evt.reply(
-            f"[{existing_user.displayname}] (https://matrix.to/#/{existing_user.mxid})"
+            f"[{existing_user.displayname}]({existing_user.matrix_to_url})"
             " was logged out from the account."
         )
     background_task.create(login_as.post_login(user, first_login=True))
     evt.sender.command_status = None
-    name = f"@{user.username}" if user.username else f"+{user.phone}"
+    name = u.format_human_tg_id(user.username, user.phone)
     if login_as != evt.sender:
-        msg = (
-            f"Successfully logged in [{login_as.mxid}](https://matrix.to/#/{login_as.mxid})"
-            f" as {name}"
-        )
+        msg = f"Successfully logged in [{login_as.mxid}]({login_as.matrix_to_url}) as {name}"
     else:
         msg = f"Successfully logged in as {name}"
     return await evt.reply(msg)
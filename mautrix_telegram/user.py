@@ -92,6 +92,10 @@ BridgeState.human_readable_errors.update(
 )
 
 
+def format_human_tg_id(username: str | None, phone: str | None) -> str:
+    return f"@{username}" if username else f"+{phone}"
+
+
 class User(DBUser, AbstractUser, BaseUser):
     by_mxid: dict[str, User] = {}
     by_tgid: dict[int, User] = {}
@@ -112,6 +116,7 @@ class User(DBUser, AbstractUser, BaseUser):
     _available_emoji_reactions_lock: asyncio.Lock
     _app_config: dict[str, Any] | None
     _app_config_hash: int
+    matrix_to_url: str
 
     def __init__(
         self,
@@ -138,6 +143,7 @@ class User(DBUser, AbstractUser, BaseUser):
         self._track_connection_task = None
         self._is_backfilling = False
         self._portals_cache = None
+        self.matrix_to_url = f"https://matrix.to/#/{self.mxid}"
 
         self._backfill_task = None
         self.wakeup_backfill_task = asyncio.Event()
@@ -171,7 +177,7 @@ class User(DBUser, AbstractUser, BaseUser):
 
     @property
     def human_tg_id(self) -> str:
-        return f"@{self.tg_username}" if self.tg_username else f"+{self.tg_phone}" or None
+        return format_human_tg_id(self.tg_username, self.tg_phone)
 
     @property
     def peer(self) -> PeerUser | None: